@@ -189,13 +189,20 @@ class Pixel2Style2PixelPredictor:
         self.model_type = 'default' if model_type is None else model_type
 
     def run(self, image):
-        src_img = run_alignment(image)
-        src_img = np.asarray(src_img)
-        transformed_image = model_cfgs[self.model_type]['transform'](src_img)
-        dst_img, latents = self.generator(
-            paddle.to_tensor(transformed_image[None, ...]), resize=False, return_latents=True)
-        dst_img = (dst_img * 0.5 + 0.5)[0].numpy() * 255
-        dst_img = dst_img.transpose((1, 2, 0))
-        dst_npy = latents[0].numpy()
-
-        return dst_img, dst_npy
+        dst_imgs, dst_npys = self.run_batch([image])
+        return dst_imgs[0], dst_npys[0]
+
+    def run_batch(self, images):
+        transformed_images = []
+        for image in images:
+            src_img = run_alignment(image)
+            src_img = np.asarray(src_img)
+            transformed_images.append(model_cfgs[self.model_type]['transform'](src_img))
+        with paddle.no_grad():
+            dst_imgs, latents = self.generator(
+                paddle.to_tensor(np.stack(transformed_images)), resize=False, return_latents=True)
+        dst_imgs = paddle.clip(dst_imgs * 127.5 + 127.5, 0, 255).round().astype('uint8')
+        dst_imgs = dst_imgs.transpose((0, 2, 3, 1)).numpy()
+        dst_npys = latents.numpy()
+
+        return dst_imgs, dst_npys
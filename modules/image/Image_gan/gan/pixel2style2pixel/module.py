@@ -15,17 +15,16 @@
 import os
 import argparse
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import paddle
 import paddlehub as hub
 from paddlehub.module.module import moduleinfo, runnable, serving
 import numpy as np
 import cv2
-from skimage.io import imread
-from skimage.transform import rescale, resize
 
 from .model import Pixel2Style2PixelPredictor
-from .util import base64_to_cv2
+from .util import base64_to_cv2, cv2_to_base64, imread
 
 
 @moduleinfo(
@@ -46,7 +45,8 @@ class pixel2style2pixel:
                        paths=None,
                        output_dir='./transfer_result/',
                        use_gpu=False,
-                       visualization=True):
+                       visualization=True,
+                       batch_size=1):
         '''
 
 
@@ -55,34 +55,54 @@ class pixel2style2pixel:
         output_dir: the dir to save the results
         use_gpu: if True, use gpu to perform the computation, otherwise cpu.
         visualization: if True, save results in output_dir.
+        batch_size: the number of images fed to the generator at once.
         '''
         results = []
-        paddle.disable_static()
+        # switching mode and device is only needed when they differ from the current ones
+        if not paddle.in_dynamic_mode():
+            paddle.disable_static()
         place = 'gpu:0' if use_gpu else 'cpu'
-        place = paddle.set_device(place)
+        if paddle.get_device() != place:
+            paddle.set_device(place)
         if images is None and paths is None:
             print('No image provided. Please input an image or a image path.')
             return
 
+        inputs = []
         if images != None:
-            for image in images:
-                image = image[:, :, ::-1]
-                out = self.network.run(image)
-                results.append(out)
-
-        if paths != None:
-            for path in paths:
-                image = cv2.imread(path)[:, :, ::-1]
-                out = self.network.run(image)
-                results.append(out)
+            inputs.extend(images)
+
+        if paths:
+            # file reads, cv2 decoding and encoding release the GIL, so they run on thread pools in this module
+            with ThreadPoolExecutor(max_workers=min(8, len(paths))) as executor:
+                inputs.extend(executor.map(imread, paths))
+
+        if inputs:
+            # images are BGR (read by cv2), the generator expects contiguous RGB
+            inputs = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in inputs]
+            dst_imgs, dst_npys = None, None
+            for start in range(0, len(inputs), batch_size):
+                batch_imgs, batch_npys = self.network.run_batch(inputs[start:start + batch_size])
+                if dst_imgs is None:
+                    # the outputs of every batch are written into buffers sized for all inputs
+                    dst_imgs = np.empty((len(inputs), ) + batch_imgs.shape[1:], dtype=batch_imgs.dtype)
+                    dst_npys = np.empty((len(inputs), ) + batch_npys.shape[1:], dtype=batch_npys.dtype)
+                dst_imgs[start:start + len(batch_imgs)] = batch_imgs
+                dst_npys[start:start + len(batch_npys)] = batch_npys
+            results = list(zip(dst_imgs, dst_npys))
 
         if visualization == True:
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir, exist_ok=True)
-            for i, out in enumerate(results):
-                if out is not None:
-                    cv2.imwrite(os.path.join(output_dir, f'output_{i}.png'), out[0][:, :, ::-1])
-                    np.save(os.path.join(output_dir, f'output_{i}.npy'), out[1])
+
+            def save_result(i, out):
+                cv2.imwrite(os.path.join(output_dir, f'output_{i}.png'), out[0][:, :, ::-1],
+                            [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                np.save(os.path.join(output_dir, f'output_{i}.npy'), out[1])
+
+            if results:
+                with ThreadPoolExecutor(max_workers=min(8, len(results))) as executor:
+                    list(executor.map(save_result, range(len(results)), results))
 
         return results
 
@@ -116,9 +136,17 @@ class pixel2style2pixel:
         """
         Run as a service.
         """
-        images_decode = [base64_to_cv2(image) for image in images]
-        results = self.style_transfer(images=images_decode, **kwargs)
-        return [result.tolist() for result in results]
+        if not images:
+            return []
+
+        def encode_result(out):
+            image = cv2.cvtColor(out[0], cv2.COLOR_RGB2BGR)
+            return {'image': cv2_to_base64(image), 'latent': out[1].tolist()}
+
+        with ThreadPoolExecutor(max_workers=min(8, len(images))) as executor:
+            images_decode = list(executor.map(base64_to_cv2, images))
+            results = self.style_transfer(images=images_decode, **kwargs)
+            return list(executor.map(encode_result, results))
 
     def add_module_config_arg(self):
         """
@@ -8,3 +8,14 @@ def base64_to_cv2(b64str):
     data = np.fromstring(data, np.uint8)
     data = cv2.imdecode(data, cv2.IMREAD_COLOR)
     return data
+
+
+def imread(path):
+    # decoding from a buffer also supports non-ASCII paths, which cv2.imread silently fails on
+    data = np.fromfile(path, dtype=np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def cv2_to_base64(image):
+    data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 92])[1]
+    return base64.b64encode(data.tobytes()).decode('utf8')
@@ -39,16 +39,34 @@ def crop_image(img, target_size, center):
     return img
 
 
+# rescale and mean/std normalization folded into a single multiply-subtract
+img_scale = (1.0 / (255 * img_std)).astype('float32')
+img_shift = (img_mean / img_std).astype('float32')
+
+
 def process_image(img):
     img = resize_short(img, target_size=256)
     img = crop_image(img, target_size=DATA_DIM, center=True)
     if img.mode != 'RGB':
         img = img.convert('RGB')
     #img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = np.array(img).astype('float32').transpose((2, 0, 1)) / 255
-    img -= img_mean
-    img /= img_std
-    return img
+    return np.asarray(img)
+
+
+def normalize_image(img, out=None):
+    """
+    Rescale, normalize and transpose a uint8 [H, W, C] image into a float32 [C, H, W] one.
+
+    :param img: uint8 image returned by process_image.
+    :type img: numpy.ndarray
+    :param out: float32 buffer of shape [C, H, W] to write into, allocated if None.
+    :type out: numpy.ndarray
+    """
+    if out is None:
+        out = np.empty((img.shape[2], img.shape[0], img.shape[1]), dtype='float32')
+    np.multiply(img.transpose((2, 0, 1)), img_scale, out=out)
+    out -= img_shift
+    return out
 
 
 def test_reader(paths=None, images=None):
@@ -57,6 +75,7 @@ def test_reader(paths=None, images=None):
     :type paths: list, each element is a str
     :param images: data of images, [N, H, W, C]
     :type images: numpy.ndarray
+    :return: uint8 [H, W, C] crops, to be converted with normalize_image.
     """
     img_list = []
     if paths:
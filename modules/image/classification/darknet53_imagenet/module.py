@@ -5,14 +5,15 @@ import argparse
 import numpy as np
 import paddle.fluid as fluid
 import paddlehub as hub
+from paddlehub.env import CACHE_HOME
 from paddlehub.module.module import moduleinfo, runnable
-from paddle.fluid.core import PaddleTensor, AnalysisConfig, create_paddle_predictor
+from paddle.inference import Config, PrecisionType, create_predictor
 from paddlehub.common.paddle_helper import add_vars_prefix
 from paddlehub.io.parser import txt_parser
 
 from darknet53_imagenet.darknet import DarkNet
 from darknet53_imagenet.processor import load_label_info
-from darknet53_imagenet.data_feed import test_reader
+from darknet53_imagenet.data_feed import test_reader, normalize_image, img_mean, img_std
 
 
 @moduleinfo(
@@ -23,11 +24,26 @@ from darknet53_imagenet.data_feed import test_reader
     author="paddlepaddle",
     author_email="paddle-dev@baidu.com")
 class DarkNet53(hub.Module):
-    def _initialize(self):
+    # loaded predictors keyed by (model path, device, tensorrt, fp16, tensorrt max batch size),
+    # every instance runs its own clone
+    _predictor_cache = {}
+
+    def _initialize(self, use_tensorrt=False, use_fp16=False, trt_max_batch_size=8):
+        """
+        :param use_tensorrt: whether to run the GPU predictor through TensorRT.
+        :type use_tensorrt: bool
+        :param use_fp16: whether to run the GPU predictor in FP16 through TensorRT.
+        :type use_fp16: bool
+        :param trt_max_batch_size: the largest batch the TensorRT engine is built for, larger batches are fed in chunks.
+        :type trt_max_batch_size: int
+        """
+        self.use_tensorrt = use_tensorrt or use_fp16
+        self.use_fp16 = use_fp16
+        self.trt_max_batch_size = trt_max_batch_size
         self.default_pretrained_model_path = os.path.join(self.directory, "darknet53_model")
         self.label_names = load_label_info(os.path.join(self.directory, "label_file.txt"))
-        self.infer_prog = None
-        self.pred_out = None
+        self._short_labels = tuple(name.split(',')[0] for name in self.label_names)
+        self._input_buf = None
         self._set_config()
 
     def get_expected_image_width(self):
@@ -37,19 +53,16 @@ class DarkNet53(hub.Module):
         return 224
 
     def get_pretrained_images_mean(self):
-        return np.array([0.485, 0.456, 0.406]).reshape(1, 3)
+        return img_mean.reshape(1, 3).copy()
 
     def get_pretrained_images_std(self):
-        return np.array([0.229, 0.224, 0.225]).reshape(1, 3)
+        return img_std.reshape(1, 3).copy()
 
     def _set_config(self):
         """
         predictor config setting
         """
-        cpu_config = AnalysisConfig(self.default_pretrained_model_path)
-        cpu_config.disable_glog_info()
-        cpu_config.disable_gpu()
-        self.cpu_predictor = create_paddle_predictor(cpu_config)
+        self.cpu_predictor = self._get_predictor(use_gpu=False)
 
         try:
             _places = os.environ["CUDA_VISIBLE_DEVICES"]
@@ -58,10 +71,43 @@ class DarkNet53(hub.Module):
         except:
             use_gpu = False
         if use_gpu:
-            gpu_config = AnalysisConfig(self.default_pretrained_model_path)
-            gpu_config.disable_glog_info()
-            gpu_config.enable_use_gpu(memory_pool_init_size_mb=500, device_id=0)
-            self.gpu_predictor = create_paddle_predictor(gpu_config)
+            self.gpu_predictor = self._get_predictor(use_gpu=True)
+
+    def _get_predictor(self, use_gpu):
+        """
+        Get a predictor of the pretrained model. The model is loaded once per settings and cloned for every instance,
+        a predictor itself is not thread-safe.
+        """
+        use_tensorrt = use_gpu and self.use_tensorrt
+        key = (self.default_pretrained_model_path, 'gpu' if use_gpu else 'cpu', use_tensorrt, use_gpu and self.use_fp16,
+               self.trt_max_batch_size if use_tensorrt else None)
+        if key not in self._predictor_cache:
+            config = Config(self.default_pretrained_model_path)
+            config.disable_glog_info()
+            config.switch_ir_optim(True)
+            config.enable_memory_optim()
+            config.switch_use_feed_fetch_ops(False)
+            if use_gpu:
+                config.enable_use_gpu(memory_pool_init_size_mb=500, device_id=0)
+                if self.use_tensorrt:
+                    # the input is always [N, 3, 224, 224], the serialized engine is reused by later runs. It is kept in
+                    # the user cache, the installed module directory may be read-only
+                    config.set_optim_cache_dir(os.path.join(CACHE_HOME, self.name, str(self.version)))
+                    config.enable_tensorrt_engine(
+                        workspace_size=1 << 30,
+                        max_batch_size=self.trt_max_batch_size,
+                        min_subgraph_size=3,
+                        precision_mode=PrecisionType.Half if self.use_fp16 else PrecisionType.Float32,
+                        use_static=True,
+                        use_calib_mode=False)
+                    config.set_trt_dynamic_shape_info({'image': [1, 3, 224, 224]},
+                                                      {'image': [self.trt_max_batch_size, 3, 224, 224]},
+                                                      {'image': [(self.trt_max_batch_size + 1) // 2, 3, 224, 224]})
+            else:
+                config.disable_gpu()
+            self._predictor_cache[key] = create_predictor(config)
+        # the clone shares the loaded weights but owns its input and output tensors
+        return self._predictor_cache[key].clone()
 
     def context(self, input_image=None, trainable=True, pretrained=True, param_prefix='', get_prediction=False):
         """Distill the Head Features, so as to perform transfer learning.
@@ -116,41 +162,41 @@ class DarkNet53(hub.Module):
         :param top_k : top k
         :type top_k : int
         """
-        if self.infer_prog is None:
-            inputs, outputs, self.infer_prog = self.context(trainable=False, pretrained=True, get_prediction=True)
-            self.infer_prog = self.infer_prog.clone(for_test=True)
-            self.pred_out = outputs['pred_out']
-        place = fluid.CUDAPlace(0) if use_gpu else fluid.CPUPlace()
-        exe = fluid.Executor(place)
         paths = paths or []
+        if use_gpu and self.use_tensorrt:
+            # the TensorRT engine rejects batches larger than the one it was built for
+            batch_size = min(batch_size, self.trt_max_batch_size)
         all_images = list(test_reader(paths, images))
         images_num = len(all_images)
         loop_num = int(np.ceil(images_num / batch_size))
 
+        if self._input_buf is None or self._input_buf.shape[0] < batch_size:
+            self._input_buf = np.empty((batch_size, 3, 224, 224), dtype=np.float32)
+
+        predictor = self.gpu_predictor if use_gpu else self.cpu_predictor
+        input_handle = predictor.get_input_handle(predictor.get_input_names()[0])
+        output_handle = predictor.get_output_handle(predictor.get_output_names()[0])
+
         res_list = []
         top_k = max(min(top_k, 1000), 1)
         for iter_id in range(loop_num):
-            batch_data = []
-            handle_id = iter_id * batch_size
-            for image_id in range(batch_size):
-                try:
-                    batch_data.append(all_images[handle_id + image_id])
-                except:
-                    pass
-            batch_data = np.array(batch_data).astype('float32')
-            data_tensor = PaddleTensor(batch_data.copy())
-            if use_gpu:
-                result = self.gpu_predictor.run([data_tensor])
-            else:
-                result = self.cpu_predictor.run([data_tensor])
-            for res in result[0].as_ndarray():
-                res_dict = {}
-                pred_label = np.argsort(res)[::-1][:top_k]
-                for k in pred_label:
-                    class_name = self.label_names[int(k)].split(',')[0]
-                    max_prob = res[k]
-                    res_dict[class_name] = max_prob
-                res_list.append(res_dict)
+            start = iter_id * batch_size
+            batch_data = all_images[start:start + batch_size]
+            input_data = self._input_buf[:len(batch_data)]
+            for image, out in zip(batch_data, input_data):
+                normalize_image(image, out=out)
+            input_handle.copy_from_cpu(input_data)
+            predictor.run()
+            probs = output_handle.copy_to_cpu()
+            # only the top_k entries of each row are partitioned out and sorted
+            pred_labels = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+            pred_probs = np.take_along_axis(probs, pred_labels, axis=1)
+            order = np.argsort(-pred_probs, axis=1)
+            pred_labels = np.take_along_axis(pred_labels, order, axis=1)
+            pred_probs = np.take_along_axis(pred_probs, order, axis=1)
+            res_list.extend({self._short_labels[k]: p
+                             for k, p in zip(row_labels, row_probs)}
+                            for row_labels, row_probs in zip(pred_labels.tolist(), pred_probs))
         return res_list
 
     def add_module_config_arg(self):
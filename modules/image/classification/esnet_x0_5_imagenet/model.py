@@ -12,15 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
+import os
+import re
+import tempfile
+from functools import lru_cache
 from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import Union
 
 import paddle
 import paddle.nn as nn
+import paddle.nn.functional as F
 from paddle import concat
 from paddle import ParamAttr
 from paddle import reshape
@@ -34,9 +40,13 @@ from paddle.nn import Linear
 from paddle.nn import MaxPool2D
 from paddle.nn.initializer import KaimingNormal
 from paddle.regularizer import L2Decay
+from paddle.static import InputSpec
 
 MODEL_STAGES_PATTERN = {"ESNet": ["blocks[2]", "blocks[9]", "blocks[12]"]}
 
+# matches one whole "name" or "name[index]" component of a layer pattern such as "blocks[2].se.conv1"
+_PATTERN_TOKEN_RE = re.compile(r"(\w+)(?:\[(\d+)\])?")
+
 
 class Identity(nn.Layer):
 
@@ -58,6 +68,8 @@ class TheseusLayer(nn.Layer):
 
     def _return_dict_hook(self, layer, input, output):
         res_dict = {"output": output}
+        if not self.res_dict:
+            return res_dict
         # 'list' is needed to avoid error raised by popping self.res_dict
         for res_key in list(self.res_dict):
             # clear the res_dict because the forward process may change according to input
@@ -221,24 +233,21 @@ def set_identity(parent_layer: nn.Layer, layer_name: str, layer_index: str = Non
         bool: True if successfully, False otherwise.
     """
 
-    stop_after = False
-    for sub_layer_name in parent_layer._sub_layers:
-        if stop_after:
-            parent_layer._sub_layers[sub_layer_name] = Identity()
-            continue
-        if sub_layer_name == layer_name:
-            stop_after = True
-
-    if layer_index and stop_after:
-        stop_after = False
-        for sub_layer_index in parent_layer._sub_layers[layer_name]._sub_layers:
-            if stop_after:
-                parent_layer._sub_layers[layer_name][sub_layer_index] = Identity()
-                continue
-            if layer_index == sub_layer_index:
-                stop_after = True
+    if layer_name not in parent_layer._sub_layers:
+        return False
+    # sub-layers are kept in insertion order, so the ones after the target are a slice of the keys
+    sub_layer_names = list(parent_layer._sub_layers)
+    for sub_layer_name in sub_layer_names[sub_layer_names.index(layer_name) + 1:]:
+        parent_layer._sub_layers[sub_layer_name] = Identity()
+
+    if layer_index:
+        if layer_index not in parent_layer._sub_layers[layer_name]._sub_layers:
+            return False
+        sub_layer_indices = list(parent_layer._sub_layers[layer_name]._sub_layers)
+        for sub_layer_index in sub_layer_indices[sub_layer_indices.index(layer_index) + 1:]:
+            parent_layer._sub_layers[layer_name][sub_layer_index] = Identity()
 
-    return stop_after
+    return True
 
 
 def parse_pattern_str(pattern: str, parent_layer: nn.Layer) -> Union[None, List[Dict[str, Union[nn.Layer, str, None]]]]:
@@ -257,20 +266,13 @@ def parse_pattern_str(pattern: str, parent_layer: nn.Layer) -> Union[None, List[
                                                                 ]
     """
 
-    pattern_list = pattern.split(".")
-    if not pattern_list:
+    pattern_tokens = _parse_pattern_tokens(pattern)
+    if pattern_tokens is None:
         msg = f"The pattern('{pattern}') is illegal. Please check and retry."
         return None
 
     layer_list = []
-    while pattern_list:
-        if '[' in pattern_list[0]:
-            target_layer_name = pattern_list[0].split('[')[0]
-            target_layer_index = pattern_list[0].split('[')[1].split(']')[0]
-        else:
-            target_layer_name = pattern_list[0]
-            target_layer_index = None
-
+    for target_layer_name, target_layer_index in pattern_tokens:
         target_layer = getattr(parent_layer, target_layer_name, None)
 
         if target_layer is None:
@@ -286,12 +288,34 @@ def parse_pattern_str(pattern: str, parent_layer: nn.Layer) -> Union[None, List[
 
         layer_list.append({"layer": target_layer, "name": target_layer_name, "index": target_layer_index})
 
-        pattern_list = pattern_list[1:]
         parent_layer = target_layer
     return layer_list
 
 
-def channel_shuffle(x, groups):
+@lru_cache(maxsize=None)
+def _parse_pattern_tokens(pattern: str) -> Optional[Tuple[Tuple[str, Optional[str]], ...]]:
+    """split the pattern into (name, index) pairs, index is None if the component has no "[index]".
+
+    None is returned if any component of the pattern is malformed, e.g. "blocks[-1]" or "conv1-bad".
+    """
+    pattern_tokens = []
+    for component in pattern.split("."):
+        match = _PATTERN_TOKEN_RE.fullmatch(component)
+        if match is None:
+            return None
+        pattern_tokens.append((match.group(1), match.group(2)))
+    return tuple(pattern_tokens)
+
+
+def channel_shuffle(x, groups, data_format="NCHW"):
+    if data_format == "NHWC":
+        batch_size, height, width, num_channels = x.shape[:4]
+        channels_per_group = num_channels // groups
+        x = reshape(x=x, shape=[batch_size, height, width, groups, channels_per_group])
+        x = transpose(x=x, perm=[0, 1, 2, 4, 3])
+        x = reshape(x=x, shape=[batch_size, height, width, num_channels])
+        return x
+
     batch_size, num_channels, height, width = x.shape[:4]
     channels_per_group = num_channels // groups
     x = reshape(x=x, shape=[batch_size, groups, channels_per_group, height, width])
@@ -300,6 +324,23 @@ def channel_shuffle(x, groups):
     return x
 
 
+def concat_shuffle(x1, x2, data_format="NCHW"):
+    """same as 'channel_shuffle(concat([x1, x2]), 2)', but interleaves the channels in a single copy."""
+    if data_format == "NHWC":
+        x = paddle.stack([x1, x2], axis=4)
+        return paddle.flatten(x, start_axis=3, stop_axis=4)
+    x = paddle.stack([x1, x2], axis=2)
+    return paddle.flatten(x, start_axis=1, stop_axis=2)
+
+
+def se_scale(x, se_vec):
+    """scale 'x' by hardsigmoid('se_vec'), the per-channel gate of shape [N, C, 1, 1] (or [N, 1, 1, C]).
+
+    The gate is computed on the tiny pooled tensor and broadcast, so 'x' is read and the result written only once.
+    """
+    return paddle.multiply(x=x, y=F.hardsigmoid(se_vec))
+
+
 def make_divisible(v, divisor=8, min_value=None):
     if min_value is None:
         min_value = divisor
@@ -311,8 +352,10 @@ def make_divisible(v, divisor=8, min_value=None):
 
 class ConvBNLayer(TheseusLayer):
 
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, groups=1, if_act=True):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, groups=1, if_act=True, data_format="NCHW"):
         super().__init__()
+        # paddle runs such convs with its dedicated depthwise_conv2d kernel instead of cuDNN's grouped conv
+        self.is_depthwise = groups == in_channels == out_channels
         self.conv = Conv2D(in_channels=in_channels,
                            out_channels=out_channels,
                            kernel_size=kernel_size,
@@ -320,17 +363,44 @@ class ConvBNLayer(TheseusLayer):
                            padding=(kernel_size - 1) // 2,
                            groups=groups,
                            weight_attr=ParamAttr(initializer=KaimingNormal()),
-                           bias_attr=False)
+                           bias_attr=False,
+                           data_format=data_format)
 
         self.bn = BatchNorm(out_channels,
                             param_attr=ParamAttr(regularizer=L2Decay(0.0)),
-                            bias_attr=ParamAttr(regularizer=L2Decay(0.0)))
+                            bias_attr=ParamAttr(regularizer=L2Decay(0.0)),
+                            data_layout=data_format)
         self.if_act = if_act
         self.hardswish = nn.Hardswish()
+        # a plain tuple is not registered by nn.Layer, so the folded tensors stay out of parameters() and state_dict()
+        self.fused_weights = None
+
+    @paddle.no_grad()
+    def fuse(self):
+        """fold 'bn' into the weights and bias of 'conv', the folded conv replaces both in dynamic eval mode.
+
+        The folded weights are dropped by the first forward in train mode and by 'ESNet.set_state_dict'. It should be
+        called again once the weights of 'conv' or 'bn' have been changed. Exported static graphs keep conv + bn,
+        which Paddle Inference folds itself.
+        """
+        scale = self.bn.weight / paddle.sqrt(self.bn._variance + self.bn._epsilon)
+        self.fused_weights = (self.conv.weight * scale.reshape([-1, 1, 1, 1]), self.bn.bias - self.bn._mean * scale)
 
     def forward(self, x):
-        x = self.conv(x)
-        x = self.bn(x)
+        if self.training:
+            self.fused_weights = None
+        if self.fused_weights is not None and paddle.in_dynamic_mode():
+            weight, bias = self.fused_weights
+            x = F.conv2d(x,
+                         weight,
+                         bias=bias,
+                         stride=self.conv._stride,
+                         padding=self.conv._padding,
+                         groups=self.conv._groups,
+                         data_format=self.conv._data_format)
+        else:
+            x = self.conv(x)
+            x = self.bn(x)
         if self.if_act:
             x = self.hardswish(x)
         return x
@@ -338,55 +408,71 @@ class ConvBNLayer(TheseusLayer):
 
 class SEModule(TheseusLayer):
 
-    def __init__(self, channel, reduction=4):
+    def __init__(self, channel, reduction=4, data_format="NCHW"):
         super().__init__()
-        self.avg_pool = AdaptiveAvgPool2D(1)
-        self.conv1 = Conv2D(in_channels=channel, out_channels=channel // reduction, kernel_size=1, stride=1, padding=0)
+        self.avg_pool = AdaptiveAvgPool2D(1, data_format=data_format)
+        self.conv1 = Conv2D(in_channels=channel,
+                            out_channels=channel // reduction,
+                            kernel_size=1,
+                            stride=1,
+                            padding=0,
+                            data_format=data_format)
         self.relu = nn.ReLU()
-        self.conv2 = Conv2D(in_channels=channel // reduction, out_channels=channel, kernel_size=1, stride=1, padding=0)
-        self.hardsigmoid = nn.Hardsigmoid()
+        self.conv2 = Conv2D(in_channels=channel // reduction,
+                            out_channels=channel,
+                            kernel_size=1,
+                            stride=1,
+                            padding=0,
+                            data_format=data_format)
 
     def forward(self, x):
-        identity = x
-        x = self.avg_pool(x)
-        x = self.conv1(x)
-        x = self.relu(x)
-        x = self.conv2(x)
-        x = self.hardsigmoid(x)
-        x = paddle.multiply(x=identity, y=x)
-        return x
+        se_vec = self.conv2(self.relu(self.conv1(self.avg_pool(x))))
+        return se_scale(x, se_vec)
 
 
 class ESBlock1(TheseusLayer):
 
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, data_format="NCHW"):
         super().__init__()
-        self.pw_1_1 = ConvBNLayer(in_channels=in_channels // 2, out_channels=out_channels // 2, kernel_size=1, stride=1)
+        self.data_format = data_format
+        self.channel_axis = 1 if data_format == "NCHW" else 3
+        # channel counts are fixed at construction, no need to query x.shape on every forward
+        self._half_c = in_channels // 2
+        self.pw_1_1 = ConvBNLayer(in_channels=in_channels // 2,
+                                  out_channels=out_channels // 2,
+                                  kernel_size=1,
+                                  stride=1,
+                                  data_format=data_format)
         self.dw_1 = ConvBNLayer(in_channels=out_channels // 2,
                                 out_channels=out_channels // 2,
                                 kernel_size=3,
                                 stride=1,
                                 groups=out_channels // 2,
-                                if_act=False)
-        self.se = SEModule(out_channels)
+                                if_act=False,
+                                data_format=data_format)
+        self.se = SEModule(out_channels, data_format=data_format)
 
-        self.pw_1_2 = ConvBNLayer(in_channels=out_channels, out_channels=out_channels // 2, kernel_size=1, stride=1)
+        self.pw_1_2 = ConvBNLayer(in_channels=out_channels,
+                                  out_channels=out_channels // 2,
+                                  kernel_size=1,
+                                  stride=1,
+                                  data_format=data_format)
 
     def forward(self, x):
-        x1, x2 = split(x, num_or_sections=[x.shape[1] // 2, x.shape[1] // 2], axis=1)
+        x1, x2 = split(x, num_or_sections=[self._half_c, self._half_c], axis=self.channel_axis)
         x2 = self.pw_1_1(x2)
         x3 = self.dw_1(x2)
-        x3 = concat([x2, x3], axis=1)
+        x3 = concat([x2, x3], axis=self.channel_axis)
         x3 = self.se(x3)
         x3 = self.pw_1_2(x3)
-        x = concat([x1, x3], axis=1)
-        return channel_shuffle(x, 2)
+        return concat_shuffle(x1, x3, self.data_format)
 
 
 class ESBlock2(TheseusLayer):
 
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, data_format="NCHW"):
         super().__init__()
+        self.channel_axis = 1 if data_format == "NCHW" else 3
 
         # branch1
         self.dw_1 = ConvBNLayer(in_channels=in_channels,
@@ -394,23 +480,39 @@ class ESBlock2(TheseusLayer):
                                 kernel_size=3,
                                 stride=2,
                                 groups=in_channels,
-                                if_act=False)
-        self.pw_1 = ConvBNLayer(in_channels=in_channels, out_channels=out_channels // 2, kernel_size=1, stride=1)
+                                if_act=False,
+                                data_format=data_format)
+        self.pw_1 = ConvBNLayer(in_channels=in_channels,
+                                out_channels=out_channels // 2,
+                                kernel_size=1,
+                                stride=1,
+                                data_format=data_format)
         # branch2
-        self.pw_2_1 = ConvBNLayer(in_channels=in_channels, out_channels=out_channels // 2, kernel_size=1)
+        self.pw_2_1 = ConvBNLayer(in_channels=in_channels,
+                                  out_channels=out_channels // 2,
+                                  kernel_size=1,
+                                  data_format=data_format)
         self.dw_2 = ConvBNLayer(in_channels=out_channels // 2,
                                 out_channels=out_channels // 2,
                                 kernel_size=3,
                                 stride=2,
                                 groups=out_channels // 2,
-                                if_act=False)
-        self.se = SEModule(out_channels // 2)
-        self.pw_2_2 = ConvBNLayer(in_channels=out_channels // 2, out_channels=out_channels // 2, kernel_size=1)
+                                if_act=False,
+                                data_format=data_format)
+        self.se = SEModule(out_channels // 2, data_format=data_format)
+        self.pw_2_2 = ConvBNLayer(in_channels=out_channels // 2,
+                                  out_channels=out_channels // 2,
+                                  kernel_size=1,
+                                  data_format=data_format)
         self.concat_dw = ConvBNLayer(in_channels=out_channels,
                                      out_channels=out_channels,
                                      kernel_size=3,
-                                     groups=out_channels)
-        self.concat_pw = ConvBNLayer(in_channels=out_channels, out_channels=out_channels, kernel_size=1)
+                                     groups=out_channels,
+                                     data_format=data_format)
+        self.concat_pw = ConvBNLayer(in_channels=out_channels,
+                                     out_channels=out_channels,
+                                     kernel_size=1,
+                                     data_format=data_format)
 
     def forward(self, x):
         x1 = self.dw_1(x)
@@ -419,7 +521,7 @@ class ESBlock2(TheseusLayer):
         x2 = self.dw_2(x2)
         x2 = self.se(x2)
         x2 = self.pw_2_2(x2)
-        x = concat([x1, x2], axis=1)
+        x = concat([x1, x2], axis=self.channel_axis)
         x = self.concat_dw(x)
         x = self.concat_pw(x)
         return x
@@ -434,8 +536,10 @@ class ESNet(TheseusLayer):
                  dropout_prob=0.2,
                  class_expand=1280,
                  return_patterns=None,
-                 return_stages=None):
+                 return_stages=None,
+                 data_format="NCHW"):
         super().__init__()
+        self.data_format = data_format
         self.scale = scale
         self.class_num = class_num
         self.class_expand = class_expand
@@ -446,39 +550,123 @@ class ESNet(TheseusLayer):
             make_divisible(464 * scale), 1024
         ]
 
-        self.conv1 = ConvBNLayer(in_channels=3, out_channels=stage_out_channels[1], kernel_size=3, stride=2)
-        self.max_pool = MaxPool2D(kernel_size=3, stride=2, padding=1)
+        self.conv1 = ConvBNLayer(in_channels=3,
+                                 out_channels=stage_out_channels[1],
+                                 kernel_size=3,
+                                 stride=2,
+                                 data_format=data_format)
+        self.max_pool = MaxPool2D(kernel_size=3, stride=2, padding=1, data_format=data_format)
 
         block_list = []
         for stage_id, num_repeat in enumerate(stage_repeats):
             for i in range(num_repeat):
                 if i == 0:
                     block = ESBlock2(in_channels=stage_out_channels[stage_id + 1],
-                                     out_channels=stage_out_channels[stage_id + 2])
+                                     out_channels=stage_out_channels[stage_id + 2],
+                                     data_format=data_format)
                 else:
                     block = ESBlock1(in_channels=stage_out_channels[stage_id + 2],
-                                     out_channels=stage_out_channels[stage_id + 2])
+                                     out_channels=stage_out_channels[stage_id + 2],
+                                     data_format=data_format)
                 block_list.append(block)
         self.blocks = nn.Sequential(*block_list)
 
-        self.conv2 = ConvBNLayer(in_channels=stage_out_channels[-2], out_channels=stage_out_channels[-1], kernel_size=1)
+        self.conv2 = ConvBNLayer(in_channels=stage_out_channels[-2],
+                                 out_channels=stage_out_channels[-1],
+                                 kernel_size=1,
+                                 data_format=data_format)
 
-        self.avg_pool = AdaptiveAvgPool2D(1)
+        self.avg_pool = AdaptiveAvgPool2D(1, data_format=data_format)
 
         self.last_conv = Conv2D(in_channels=stage_out_channels[-1],
                                 out_channels=self.class_expand,
                                 kernel_size=1,
                                 stride=1,
                                 padding=0,
-                                bias_attr=False)
+                                bias_attr=False,
+                                data_format=data_format)
         self.hardswish = nn.Hardswish()
         self.dropout = Dropout(p=dropout_prob, mode="downscale_in_infer")
         self.flatten = nn.Flatten(start_axis=1, stop_axis=-1)
         self.fc = Linear(self.class_expand, self.class_num)
 
-        super().init_res(stages_pattern, return_patterns=return_patterns, return_stages=return_stages)
+        if return_patterns or return_stages is not None:
+            super().init_res(stages_pattern, return_patterns=return_patterns, return_stages=return_stages)
+
+    def fuse(self):
+        """fold the BatchNorm of every ConvBNLayer into its convolution for inference.
+        """
+        for layer in self.sublayers():
+            if isinstance(layer, ConvBNLayer):
+                layer.fuse()
+
+    def set_state_dict(self, state_dict, use_structured_name=True):
+        """load 'state_dict' like 'nn.Layer.set_state_dict', and drop the folded weights of 'fuse()' it makes stale.
+        """
+        for layer in self.sublayers():
+            if isinstance(layer, ConvBNLayer):
+                layer.fused_weights = None
+        return super().set_state_dict(state_dict, use_structured_name=use_structured_name)
+
+    # the aliases of nn.Layer are bound to its own set_state_dict
+    set_dict = set_state_dict
+    load_dict = set_state_dict
+
+    def quantize(self, calib_loader: Any, save_dir: str, batch_nums: int = None, algo: str = "min_max") -> str:
+        """post-training quantize the model to INT8 and save it as an inference model.
+
+        Weights are quantized per channel and activations per tensor, both with Paddle's symmetric abs-max scales.
+
+        Args:
+            calib_loader (Any): An iterable of float32 calibration batches shaped [N, 3, 224, 224].
+            save_dir (str): The directory to save the quantized inference model.
+            batch_nums (int, optional): The number of batches used to calibrate. Defaults to None, all of calib_loader.
+            algo (str, optional): The algorithm to collect activation ranges. Defaults to "min_max".
+
+        Returns:
+            str: The path prefix of the saved quantized model, 'save_dir/inference'.
+        """
+        try:
+            from paddle.static.quantization import PostTrainingQuantization
+        except ImportError:
+            # paddle < 2.5
+            from paddle.fluid.contrib.slim.quantization import PostTrainingQuantization
+
+        self.eval()
+
+        def batch_generator():
+            for batch in calib_loader:
+                yield [batch]
+
+        with tempfile.TemporaryDirectory() as fp32_dir:
+            save_inference_model(self, os.path.join(fp32_dir, "inference"))
+            paddle.enable_static()
+            try:
+                ptq = PostTrainingQuantization(executor=paddle.static.Executor(paddle.CPUPlace()),
+                                               model_dir=fp32_dir,
+                                               model_filename="inference.pdmodel",
+                                               params_filename="inference.pdiparams",
+                                               batch_generator=batch_generator,
+                                               batch_nums=batch_nums,
+                                               algo=algo,
+                                               # fold conv + bn before the weights are quantized
+                                               optimize_model=True,
+                                               quantizable_op_type=[
+                                                   "conv2d", "depthwise_conv2d", "mul", "matmul", "matmul_v2"
+                                               ],
+                                               weight_quantize_type="channel_wise_abs_max")
+                ptq.quantize()
+                ptq.save_quantized_model(save_dir,
+                                         model_filename="inference.pdmodel",
+                                         params_filename="inference.pdiparams")
+            finally:
+                paddle.disable_static()
+        return os.path.join(save_dir, "inference")
 
     def forward(self, x):
+        if self.data_format == "NHWC":
+            # the input is always NCHW
+            x = paddle.transpose(x, [0, 2, 3, 1])
         x = self.conv1(x)
         x = self.max_pool(x)
         x = self.blocks(x)
@@ -492,6 +680,17 @@ class ESNet(TheseusLayer):
         return x
 
 
+def save_inference_model(model: nn.Layer, path_prefix: str) -> None:
+    """convert the model to a static graph and save it as 'path_prefix.pdmodel' and 'path_prefix.pdiparams'.
+
+    Args:
+        model (nn.Layer): The model to save, in eval mode.
+        path_prefix (str): The path prefix of the saved files.
+    """
+    # the forward is traced into a static program while saving, 'model' itself stays in dynamic mode
+    paddle.jit.save(model, path_prefix, input_spec=[InputSpec(shape=[None, 3, 224, 224], dtype="float32")])
+
+
 def ESNet_x0_5(pretrained=False, use_ssld=False, **kwargs):
     """
     ESNet_x0_5
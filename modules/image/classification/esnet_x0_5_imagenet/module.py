@@ -14,20 +14,26 @@
 import argparse
 import copy
 import os
+import shutil
+import tempfile
 
 import cv2
 import numpy as np
 import paddle
+from paddle.inference import Config
+from paddle.inference import create_predictor
 from skimage.io import imread
 from skimage.transform import rescale
 from skimage.transform import resize
 
 import paddlehub as hub
 from .model import ESNet_x0_5
+from .model import save_inference_model
 from .processor import base64_to_cv2
 from .processor import create_operators
 from .processor import Topk
 from .utils import get_config
+from paddlehub.env import CACHE_HOME
 from paddlehub.module.module import moduleinfo
 from paddlehub.module.module import runnable
 from paddlehub.module.module import serving
@@ -41,7 +47,16 @@ from paddlehub.module.module import serving
             version="1.0.0")
 class Esnet_x0_5_Imagenet:
 
-    def __init__(self):
+    def __init__(self, static: bool = False, use_fp16: bool = False, int8_model_path: str = None):
+        '''
+        Args:
+            static (bool): Whether to run the model exported as a static graph by Paddle Inference instead of
+                           running it in dynamic mode.
+            use_fp16 (bool): Whether to run the convolutions and the classifier in float16 on GPU, only works in
+                             dynamic mode.
+            int8_model_path (str): The path prefix of an INT8 model saved by `ESNet.quantize`, which is run by the
+                                   MKL-DNN INT8 kernels on CPU. It implies `static=True`.
+        '''
         self.config = get_config(os.path.join(self.directory, 'ESNet_x0_5.yaml'), show=False)
         self.label_path = os.path.join(self.directory, 'imagenet1k_label_list.txt')
         self.pretrain_path = os.path.join(self.directory, 'ESNet_x0_5_pretrained.pdparams')
@@ -49,8 +64,74 @@ class Esnet_x0_5_Imagenet:
         self.model = ESNet_x0_5()
         param_state_dict = paddle.load(self.pretrain_path)
         self.model.set_dict(param_state_dict)
+        self.model.eval()
+        self.model.fuse()
         self.preprocess_funcs = create_operators(self.config["Infer"]["transforms"])
 
+        self.static = static or int8_model_path is not None
+        self.use_fp16 = use_fp16
+        self.int8_model_path = int8_model_path
+        self.predictors = {}
+        if self.static:
+            # exported to the user cache, the installed module directory may be read-only
+            self.inference_path = os.path.join(CACHE_HOME, self.name, str(self.version), 'inference')
+            if not os.path.exists(self.inference_path + '.pdmodel'):
+                self._export_inference_model()
+
+    def _export_inference_model(self):
+        '''
+        Export the model as a static graph to `self.inference_path`. The files are written to a temporary directory and
+        moved into place, so workers starting at the same time never load a half-written model.
+        '''
+        export_dir = os.path.dirname(self.inference_path)
+        os.makedirs(export_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=export_dir)
+        try:
+            save_inference_model(self.model, os.path.join(tmp_dir, 'inference'))
+            # the .pdmodel file is moved last, it marks a complete export
+            for suffix in ('.pdiparams', '.pdmodel'):
+                os.replace(os.path.join(tmp_dir, 'inference' + suffix), self.inference_path + suffix)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _get_predictor(self, use_gpu: bool):
+        '''
+        Get the Paddle Inference predictor of the exported model, which is created on first use per device.
+        '''
+        if use_gpu not in self.predictors:
+            use_int8 = self.int8_model_path is not None and not use_gpu
+            model_path = self.int8_model_path if use_int8 else self.inference_path
+            config = Config(model_path + '.pdmodel', model_path + '.pdiparams')
+            config.disable_glog_info()
+            config.switch_ir_optim(True)
+            config.enable_memory_optim()
+            config.switch_use_feed_fetch_ops(False)
+            if use_gpu:
+                config.enable_use_gpu(100, 0)
+            else:
+                config.disable_gpu()
+                config.enable_mkldnn()
+                # reuse the oneDNN primitives created for recently seen input shapes
+                config.set_mkldnn_cache_capacity(10)
+                if use_int8:
+                    config.enable_mkldnn_int8({'conv2d', 'depthwise_conv2d', 'matmul', 'matmul_v2'})
+            predictor = create_predictor(config)
+            if not use_gpu:
+                # the first run creates and caches the oneDNN primitives
+                input_handle = predictor.get_input_handle(predictor.get_input_names()[0])
+                input_handle.copy_from_cpu(np.zeros((1, 3, 224, 224), dtype='float32'))
+                predictor.run()
+            self.predictors[use_gpu] = predictor
+        return self.predictors[use_gpu]
+
+    def _run_predictor(self, batch_data: list, use_gpu: bool):
+        predictor = self._get_predictor(use_gpu)
+        input_handle = predictor.get_input_handle(predictor.get_input_names()[0])
+        output_handle = predictor.get_output_handle(predictor.get_output_names()[0])
+        input_handle.copy_from_cpu(np.stack(batch_data))
+        predictor.run()
+        return paddle.to_tensor(output_handle.copy_to_cpu())
+
     def classification(self,
                        images: list = None,
                        paths: list = None,
@@ -94,14 +175,21 @@ class Esnet_x0_5_Imagenet:
                 imagedata = process(imagedata)
             batch_data.append(imagedata)
             if len(batch_data) >= batch_size or idx == len(inputs) - 1:
-                batch_tensor = paddle.to_tensor(batch_data)
-                out = self.model(batch_tensor)
+                if self.static:
+                    out = self._run_predictor(batch_data, use_gpu)
+                else:
+                    batch_tensor = paddle.to_tensor(batch_data)
+                    # no autograd graph is recorded, so every activation is freed as soon as its last consumer ran.
+                    # conv2d and matmul run in float16 while the numerically sensitive ops are kept in float32
+                    with paddle.no_grad(), paddle.amp.auto_cast(enable=use_gpu and self.use_fp16):
+                        out = self.model(batch_tensor)
                 if isinstance(out, list):
                     out = out[0]
                 if isinstance(out, dict) and "logits" in out:
                     out = out["logits"]
                 if isinstance(out, dict) and "output" in out:
                     out = out["output"]
+                out = out.astype('float32')
                 result = postprocess_func(out)
                 results.extend(result)
                 batch_data.clear()
@@ -0,0 +1,153 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import paddle
+import paddle.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from model import channel_shuffle
+from model import concat_shuffle
+from model import ConvBNLayer
+from model import ESNet_x0_5
+from model import Identity
+from model import parse_pattern_str
+from model import set_identity
+
+
+class _Net(nn.Layer):
+
+    def __init__(self):
+        super().__init__()
+        self.conv1 = nn.Linear(2, 2)
+        self.blocks = nn.Sequential(nn.Linear(2, 2), nn.Linear(2, 2), nn.Linear(2, 2))
+        self.fc = nn.Linear(2, 2)
+
+
+class TestPatternParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.net = _Net()
+
+    def test_parse_indexed_pattern(self):
+        layer_list = parse_pattern_str("blocks[1]", self.net)
+        self.assertEqual(len(layer_list), 1)
+        self.assertEqual(layer_list[0]["name"], "blocks")
+        self.assertEqual(layer_list[0]["index"], "1")
+        self.assertIs(layer_list[0]["layer"], self.net.blocks[1])
+
+    def test_parse_dotted_pattern(self):
+        layer_list = parse_pattern_str("blocks.2", self.net)
+        self.assertEqual([layer["name"] for layer in layer_list], ["blocks", "2"])
+        self.assertIs(layer_list[-1]["layer"], self.net.blocks[2])
+
+    def test_parse_illegal_pattern(self):
+        for pattern in ["blocks[-1]", "conv1-bad", "blocks[5]", "missing", "", "blocks..1"]:
+            self.assertIsNone(parse_pattern_str(pattern, self.net), pattern)
+
+    def test_set_identity(self):
+        conv1, block0, block1 = self.net.conv1, self.net.blocks[0], self.net.blocks[1]
+        self.assertTrue(set_identity(self.net, "blocks", "1"))
+        self.assertIs(self.net.conv1, conv1)
+        self.assertIs(self.net.blocks[0], block0)
+        self.assertIs(self.net.blocks[1], block1)
+        self.assertIsInstance(self.net.blocks[2], Identity)
+        self.assertIsInstance(self.net.fc, Identity)
+
+    def test_set_identity_missing(self):
+        self.assertFalse(set_identity(self.net, "missing"))
+        self.assertFalse(set_identity(self.net, "blocks", "5"))
+
+
+def _randomize_bn(layer):
+    for sub_layer in layer.sublayers(include_self=True):
+        if isinstance(sub_layer, ConvBNLayer):
+            num_channels = sub_layer.bn.weight.shape[0]
+            sub_layer.bn.weight.set_value(paddle.rand([num_channels]) + 0.5)
+            sub_layer.bn.bias.set_value(paddle.randn([num_channels]))
+            sub_layer.bn._mean.set_value(paddle.randn([num_channels]))
+            sub_layer.bn._variance.set_value(paddle.rand([num_channels]) + 0.5)
+
+
+class TestConcatShuffle(unittest.TestCase):
+
+    def test_concat_shuffle(self):
+        for data_format, channel_axis in [("NCHW", 1), ("NHWC", 3)]:
+            with self.subTest(data_format=data_format):
+                shape = [2, 6, 5, 7] if data_format == "NCHW" else [2, 5, 7, 6]
+                x1, x2 = paddle.randn(shape), paddle.randn(shape)
+                # the reshape -> transpose -> reshape shuffle ESBlock1 ran before concat_shuffle
+                expected = channel_shuffle(paddle.concat([x1, x2], axis=channel_axis), 2, data_format)
+                np.testing.assert_array_equal(concat_shuffle(x1, x2, data_format).numpy(), expected.numpy())
+
+
+class TestConvBNFusion(unittest.TestCase):
+
+    def check_fuse(self, data_format, groups, stride):
+        paddle.seed(0)
+        layer = ConvBNLayer(8, 8, kernel_size=3, stride=stride, groups=groups, data_format=data_format)
+        _randomize_bn(layer)
+        layer.eval()
+        shape = [2, 8, 16, 16] if data_format == "NCHW" else [2, 16, 16, 8]
+        x = paddle.randn(shape)
+        expected = layer(x).numpy()
+        layer.fuse()
+        self.assertIsNotNone(layer.fused_weights)
+        np.testing.assert_allclose(layer(x).numpy(), expected, rtol=1e-4, atol=1e-4)
+
+    def test_fuse(self):
+        for data_format in ["NCHW", "NHWC"]:
+            for groups, stride in [(1, 1), (8, 2)]:
+                with self.subTest(data_format=data_format, groups=groups, stride=stride):
+                    self.check_fuse(data_format, groups, stride)
+
+    def test_fuse_state_not_registered(self):
+        layer = ConvBNLayer(8, 8, kernel_size=3)
+        keys = set(layer.state_dict())
+        num_params = len(layer.parameters())
+        layer.fuse()
+        self.assertEqual(set(layer.state_dict()), keys)
+        self.assertEqual(len(layer.parameters()), num_params)
+
+    def test_fuse_dropped(self):
+        model = ESNet_x0_5()
+        model.eval()
+        model.fuse()
+        model.set_state_dict(ESNet_x0_5().state_dict())
+        for layer in model.sublayers():
+            if isinstance(layer, ConvBNLayer):
+                self.assertIsNone(layer.fused_weights)
+
+        layer = ConvBNLayer(8, 8, kernel_size=3)
+        layer.eval()
+        layer.fuse()
+        layer.train()
+        layer(paddle.randn([2, 8, 16, 16]))
+        self.assertIsNone(layer.fused_weights)
+
+
+class TestESNetDataFormat(unittest.TestCase):
+
+    def test_nhwc_matches_nchw(self):
+        paddle.seed(0)
+        model_nchw = ESNet_x0_5()
+        _randomize_bn(model_nchw)
+        model_nhwc = ESNet_x0_5(data_format="NHWC")
+        model_nhwc.set_state_dict(model_nchw.state_dict())
+        model_nchw.eval()
+        model_nhwc.eval()
+        x = paddle.randn([2, 3, 224, 224])
+        np.testing.assert_allclose(model_nhwc(x).numpy(), model_nchw(x).numpy(), rtol=1e-4, atol=1e-4)
+
+    def test_nhwc_input_gradient(self):
+        model = ESNet_x0_5(data_format="NHWC")
+        model.eval()
+        x = paddle.randn([1, 3, 224, 224])
+        x.stop_gradient = False
+        model(x).sum().backward()
+        self.assertIsNotNone(x.grad)
+
+
+if __name__ == "__main__":
+    unittest.main()